@@ -166,8 +166,9 @@ class ColMetadata:
             self.values_count += 1
 
     def guessed_type(self):
-        popular_types = [t for t, c in sorted(self.__guess_map.items(), key=lambda x: x[1], reverse=True) if c > 0]
-        return popular_types[0] if popular_types else None
+        # the first of the most counted types, as a stable sort would give
+        popular_type = max(((t, c) for t, c in self.__guess_map.items() if c > 0), key=lambda x: x[1], default=None)
+        return popular_type[0] if popular_type else None
 
     def colnum_letter(self):
         string = ""
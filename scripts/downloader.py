@@ -29,6 +29,8 @@ downloads = []
 download_urls = set()
 fn_re = re.compile(r"(?i)filename=(?P<fn>.+)[\s$]?")
 max_retries = 5
+# shared by all the downloads, to keep the connections to the same hosts alive
+session = None
 
 
 class DStatus(Enum):
@@ -86,7 +88,6 @@ class Download:
             self.start_time = datetime.now()
             self.downloaded_bytes = 0
             url = self.url
-            session = requests.session()
             try:
                 response = session.head(url)
                 self.file_size = int(response.headers.get('content-length', 0))
@@ -121,8 +122,8 @@ class Download:
                         file_mode = 'wb'
                         resume_header = {}
 
-                    with open(tmp_output_file, file_mode) as f:
-                        response = session.get(url, headers=resume_header, stream=True)
+                    with open(tmp_output_file, file_mode) as f, \
+                            session.get(url, headers=resume_header, stream=True) as response:
                         for chunk in response.iter_content(chunk_size=1024):
                             if chunk:
                                 f.write(chunk)
@@ -141,7 +142,6 @@ class Download:
                 self.error_text = f"{type(e)} - {e}"
             finally:
                 self.end_time = datetime.now()
-                session.close()
 
         if self.status == DStatus.Error:
             with open(os.path.join(output_dir, f"Errors.urls"), 'a') as f:
@@ -288,6 +288,11 @@ if __name__ == "__main__":
     # min size
     min_size = _parse_size(args.size) if args.size else 0
 
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=args.workers)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
     if args.clipboard:
         direct_download()
     else:
@@ -4,49 +4,68 @@ import json
 import os
 import re
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
+import ijson
 import requests
 
 import abnconv
 from abnconv import QIFOutput, Trsx
 
 
+ICSCARDS_URL = "https://www.icscards.nl"
+MAX_CONNECTIONS = 8
+
+
+def icscards_session(_username, _password):
+    """
+    Return a session logged in to icscards, with the XSRF token already set in the headers
+    """
+    s = requests.Session()
+    s.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=MAX_CONNECTIONS))
+    s.get(ICSCARDS_URL)
+
+    # logging in
+    s.post("%s/pub/nl/pub/login" % ICSCARDS_URL, json={"loginType": "PASSWORD",
+                                                      "virtualPortal": "ICS-ABNAMRO",
+                                                      "username": _username,
+                                                      "password": _password})
+    s.headers['X-XSRF-TOKEN'] = s.cookies.get('XSRF-TOKEN')
+    return s
+
+
 def extract_transactions():
-    base_url = "https://www.icscards.nl"
-    login_url = "%s/pub/nl/pub/login" % base_url
-    account_url = "%s/sec/nl/sec/allaccountsv2" % base_url
+    account_url = "%s/sec/nl/sec/allaccountsv2" % ICSCARDS_URL
     transactions_url = \
         "{baseurl}/sec/nl/sec/transactions/search?fromDate={start_date}&untilDate={end_date}&accountNumber=" \
-            .format(baseurl=base_url,
+            .format(baseurl=ICSCARDS_URL,
                     start_date=from_date.strftime("%Y-%m-%d"),
                     end_date=to_date.strftime("%Y-%m-%d"), )
 
-    s = requests.Session()
-    s.get(base_url)
+    s = icscards_session(username, password)
 
-    # logging in
-    s.post(login_url, json={"loginType": "PASSWORD",
-                            "virtualPortal": "ICS-ABNAMRO",
-                            "username": username,
-                            "password": password})
-    # extract header
-    more_headers = {
-        'X-XSRF-TOKEN': s.cookies.get('XSRF-TOKEN')
-    }
-
-    r = s.get(account_url, headers=more_headers)
+    r = s.get(account_url)
     if not r.ok:
         raise ValueError
 
+    def account_transactions(account_number):
+        _transactions = list()
+        # parse the response while it is downloaded, without holding the whole body in memory
+        with s.get(transactions_url + account_number, stream=True) as _r:
+            _r.raw.decode_content = True
+            for account_transaction in ijson.items(_r.raw, 'item', use_float=True):
+                account_transaction['accountNumber'] = account_number
+                _transactions.append(account_transaction)
+        return _transactions
+
+    account_numbers = [str(ad['accountNumber']) for ad in json.loads(r.text) if ad['valid'] is True]
+
+    # the searches are independent, run them together on the same (already authenticated) session
     all_transactions = list()
-    for account_data in [ad for ad in json.loads(r.text) if ad['valid'] is True]:
-        account_number = str(account_data['accountNumber'])
-        r = s.get(transactions_url + account_number, headers=more_headers)
-        account_transactions = json.loads(r.text)
-        for account_transaction in account_transactions:
-            account_transaction['accountNumber'] = account_number
-            all_transactions.append(account_transaction)
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_CONNECTIONS, len(account_numbers)))) as executor:
+        for _transactions in executor.map(account_transactions, account_numbers):
+            all_transactions += _transactions
 
     return all_transactions
 
@@ -98,8 +117,14 @@ def load_settings():
     return args.username, _password, _from, _to, _file
 
 
+def _parse_date(iso_date):
+    # yyyy-mm-dd, slicing is much faster than strptime which parses the format on every call
+    return datetime(int(iso_date[:4]), int(iso_date[5:7]), int(iso_date[8:10]))
+
+
 def export_transactions():
     payee_re = re.compile(r"((www.)?[\w\.]+).+")
+    ics_accounts = dict()
 
     with QIFOutput(file) as out:
         for transaction in transactions:
@@ -108,14 +133,17 @@ def export_transactions():
                     or transaction['typeOfTransaction'] == 'A':
                 continue
 
-            account = abnconv.find_account(transaction['accountNumber'])
+            account_number = transaction['accountNumber']
+            if account_number not in ics_accounts:
+                ics_accounts[account_number] = abnconv.find_account(account_number)
+            account = ics_accounts[account_number]
             description = transaction['description']
 
             tsx = Trsx(account.iban)
             tsx.type = 'Bank'
             tsx.memo = description
 
-            tsx.date = datetime.strptime(transaction['transactionDate'], '%Y-%m-%d')
+            tsx.date = _parse_date(transaction['transactionDate'])
             tsx.amount = float(transaction['billingAmount']) * -1
 
             tsx.payee = payee_re.search(description).group(1)
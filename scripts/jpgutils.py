@@ -1,54 +1,110 @@
 import argparse
+import csv
+import logging
 import os
 import shutil
+import sqlite3
 import subprocess
-import sys
+from concurrent.futures import ThreadPoolExecutor
 from tempfile import mkdtemp
 
+from PIL import Image
+
+JPEG_QUALITY = 90
+WALK_WORKERS = 16
+SYMLINK_WORKERS = 32
+
+
+def _suffixes(ext):
+    return tuple('.' + e.lower() for e in ext.split(","))
+
+
+def _walk(top, suffixes, skip_hidden=False):
+    """
+    Scan the tree using a pool of threads, as the listing of a folder is mostly waiting for the disk (or the network).
+    Return a list of (folder, sorted picture entries) with the folders in the same order of a top-down os.walk
+    with sorted sub folders
+    """
+    def scan(folder):
+        pictures = []
+        sub_folders = []
+        try:
+            with os.scandir(folder) as it:
+                for entry in it:
+                    if entry.is_dir():
+                        # as for os.walk, symlinks to folders are not followed
+                        if not entry.is_symlink() and not (skip_hidden and entry.name[0] == '.'):
+                            sub_folders.append(entry.path)
+                    elif entry.name.lower().endswith(suffixes):
+                        pictures.append(entry)
+        except OSError:
+            # as for os.walk, a folder that can't be read is skipped
+            logging.debug("Cannot read %s, skipped", folder)
+            return folder, [], []
+
+        pictures.sort(key=lambda e: e.name)
+        return folder, pictures, sub_folders
+
+    folders = []
+    with ThreadPoolExecutor(max_workers=WALK_WORKERS) as executor:
+        pending = [executor.submit(scan, top)]
+        while pending:
+            folder, pictures, sub_folders = pending.pop().result()
+            folders.append((folder, pictures))
+            pending += [executor.submit(scan, f) for f in sub_folders]
+
+    folders.sort(key=lambda f: f[0][len(top):].split(os.sep))
+    return folders
+
 
 def showcase():
     assert os.path.exists(args.target), "Target folder %s doesn't exist" % args.target
 
-    exts = ['.' + e for e in args.ext.split(",")]
-    # source_files = [os.path.join(r, f) for r, fd, fl in os.walk(os.path.abspath(args.target)) for f in fl
-    #                 if os.path.splitext(f)[1].lower() in exts]
+    suffixes = _suffixes(args.ext)
 
     tmp = mkdtemp(prefix="showcase_")
-    first = None
+    links = []
     c = 0
-    for r, dirs, files in os.walk(os.path.abspath(args.target)):
-        dirs.sort()
-        for file in [os.path.join(r, f) for f in sorted(files) if os.path.splitext(f)[1].lower() in exts]:
+    for r, entries in _walk(os.path.abspath(args.target), suffixes):
+        for file in [e.path for e in entries]:
             c += 1
-            link_name = "%04i_%s" % (c, os.path.basename(file))
-            if not first:
-                first = os.path.join(tmp, link_name)
-            os.symlink(file, os.path.join(tmp, link_name))
-            print("%s -> %s" % (file, os.path.join(tmp, link_name)))
+            links.append((file, os.path.join(tmp, f"{c:04d}_{os.path.basename(file)}")))
+
+    if not links:
+        logging.info("No picture found in %s", args.target)
+        return
 
-    subprocess.call(["xdg-open", first])
+    def symlink(link):
+        os.symlink(*link)
+        logging.debug("%s -> %s", *link)
+
+    # the viewer is started on the first picture while the others are still being linked
+    symlink(links[0])
+    subprocess.Popen(["xdg-open", links[0][1]])
+    with ThreadPoolExecutor(max_workers=SYMLINK_WORKERS) as executor:
+        list(executor.map(symlink, links[1:]))
 
 
 def permanent_showcase():
     SHOWCASE_NAME = "__showcase"
     target = args.target
     counter = {}
+    links = []
 
     def create_linker(_folder):
         if _folder not in counter:
             counter[_folder] = 0
 
+        showcase_folder = os.path.join(_folder, SHOWCASE_NAME)
+
         def _linker(item):
             if not args.skip_root or (_folder != target):
                 c = counter[_folder]
                 counter[_folder] += 1
 
-                showcase_folder = os.path.join(_folder, SHOWCASE_NAME)
-                os.makedirs(showcase_folder, exist_ok=True)
-                link_name = os.path.join(showcase_folder, "%04d_%s" % (c, os.path.basename(item)))
+                link_name = os.path.join(showcase_folder, f"{c:04d}_{os.path.basename(item)}")
                 path_to_item = os.path.relpath(item, showcase_folder)
-                if not os.path.exists(link_name):
-                    os.symlink(path_to_item, link_name)
+                links.append((path_to_item, link_name))
 
         return _linker
 
@@ -59,16 +115,82 @@ def permanent_showcase():
             if os.path.exists(sc_folder):
                 shutil.rmtree(sc_folder)
 
-        for entry in sorted([e for e in os.scandir(folder) if e.name != SHOWCASE_NAME], key=lambda e: e.name):
-            entry_path = os.path.join(folder, entry.name)
+        with os.scandir(folder) as it:
+            entries = sorted((e for e in it if e.name != SHOWCASE_NAME), key=lambda e: e.name)
+
+        for entry in entries:
+            # is_dir() and is_file() share the entry type (and the stat, cached by the entry, for symlinks)
             if entry.is_dir():
-                picture_list(entry_path, linkers + [create_linker(folder)])
+                picture_list(entry.path, linkers + [create_linker(folder)])
             elif entry.is_file() and not args.remove:
                 for linker in linkers:
-                    linker(entry_path)
+                    linker(entry.path)
+
+    def symlink(link):
+        try:
+            os.symlink(*link)
+        except FileExistsError:
+            pass
 
     picture_list(target, [print])
 
+    # only folders with something to show get a showcase folder
+    for showcase_folder in {os.path.dirname(link_name) for _, link_name in links}:
+        os.makedirs(showcase_folder, exist_ok=True)
+
+    # each link is a blocking round trip to the file system (even more on network shares), create them in parallel
+    with ThreadPoolExecutor(max_workers=SYMLINK_WORKERS) as executor:
+        list(executor.map(symlink, links))
+
+
+def _tmp_path(path):
+    return os.path.join(os.path.dirname(path), "." + os.path.basename(path))
+
+
+def _parse_size(resize):
+    try:
+        width, height = resize.lower().split("x")
+        return int(width), int(height)
+    except ValueError:
+        raise ValueError("Not valid format for size '%s' (expected WIDTHxHEIGHT)" % resize)
+
+
+def _resize_picture(source_picture, target_picture, size):
+    # work on a hidden file, the target is replaced only once the picture is ready
+    tmp_picture = _tmp_path(target_picture)
+    try:
+        with Image.open(source_picture) as im:
+            picture_format = im.format
+            # the source is read once and the resized picture written once, with no intermediate full size copy
+            im.thumbnail(size, Image.LANCZOS)
+            im.save(tmp_picture, picture_format,
+                    quality=JPEG_QUALITY,
+                    exif=im.info.get('exif', b''),
+                    icc_profile=im.info.get('icc_profile'))
+        os.replace(tmp_picture, target_picture)
+        return True
+    except OSError as e:
+        # a picture that can't be read (or written) doesn't stop the others
+        logging.error("Cannot resize %s: %s", source_picture, e)
+        try:
+            os.remove(tmp_picture)
+        except FileNotFoundError:
+            pass
+        return False
+
+
+def _resize_pictures(pictures, size):
+    """
+    Resize the (source, target) pictures in parallel (Pillow releases the GIL while decoding, resizing and encoding)
+    and return the number of pictures that couldn't be resized
+    """
+    # each target folder is created once, not once per picture
+    for target_folder in {os.path.dirname(target) for _, target in pictures}:
+        os.makedirs(target_folder, exist_ok=True)
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as executor:
+        return sum(not resized for resized in executor.map(lambda p: _resize_picture(*p, size), pictures))
+
 
 def catalog():
     source = os.path.expanduser(args.source)
@@ -78,16 +200,15 @@ def catalog():
     if not os.path.exists(target):
         os.makedirs(target, exist_ok=True)
 
-    exts = ['.' + e for e in args.ext.split(",")]
+    suffixes = _suffixes(args.ext)
+    size = _parse_size(args.resize)
+    pictures = []
 
-    for root, folders, files in os.walk(source):
-        print('scan %s...' % root)
-        if os.path.basename(os.path.normpath(root))[0] == '.':
-            continue
-
-        relative_root = root[len(source):]
-        for file in [f for f in files if os.path.splitext(f)[1].lower() in exts]:
-            print('file %s...' % file)
+    for root, entries in _walk(source, suffixes, skip_hidden=True):
+        logging.debug('scan %s...', root)
+        relative_root = os.path.relpath(root, source)
+        for file in [e.name for e in entries]:
+            logging.debug('file %s...', file)
             source_picture = os.path.join(root, file)
             target_picture = os.path.join(target, relative_root, file)
 
@@ -95,120 +216,123 @@ def catalog():
 
             if not target_exists or args.force:
                 if target_exists:
-                    print('Replacing %s...' % target_picture)
-                    os.remove(target_picture)
-                print("Copying %s..." % os.path.join(relative_root, file), end='')
-                sys.stdout.flush()
-                os.makedirs(os.path.dirname(target_picture), exist_ok=True)
-                shutil.copyfile(source_picture, target_picture)
-                print("resizing...", end='')
-                sys.stdout.flush()
-                subprocess.call(["mogrify", "-resize", args.resize, target_picture])
-                print('done')
+                    logging.info('Replacing %s...', target_picture)
+                else:
+                    logging.info("Adding %s...", os.path.join(relative_root, file))
+                pictures.append((source_picture, target_picture))
             else:
-                print("File %s already exist, skipped" % target_picture)
-
-    print("done")
+                logging.info("File %s already exist, skipped", target_picture)
 
+    if pictures:
+        logging.info("Resizing %d pictures...", len(pictures))
+        failed = _resize_pictures(pictures, size)
+        if failed:
+            logging.info("%d pictures couldn't be resized", failed)
 
-catalog_file = os.path.expanduser("~/.jpgutils-catalog.idx")
+    logging.info("done")
 
 
-def _load_catalog_index():
-    index = {}
-    if os.path.exists(catalog_file):
-        with open(catalog_file, 'r') as f:
-            first = True
-            for line in f.readlines():
-                if first:
-                    first = False
-                    continue
-                path, mtime = line[:-1].split('\t')
-                index[path] = float(mtime)
+catalog_file = os.path.expanduser("~/.jpgutils-catalog.sqlite")
+legacy_catalog_file = os.path.expanduser("~/.jpgutils-catalog.idx")
 
-    return index
 
+def _open_catalog_index():
+    """
+    Open the index of the original pictures modification times, importing the old text index the first time
+    """
+    new_index = not os.path.exists(catalog_file)
+    index = sqlite3.connect(catalog_file)
+    index.execute("CREATE TABLE IF NOT EXISTS idx (path TEXT PRIMARY KEY, mtime REAL)")
 
-def _write_catalog_index(index: dict):
-    with open(catalog_file, 'w') as f:
-        f.write("original_path\ttimestamp%n")
+    if new_index and os.path.exists(legacy_catalog_file):
+        with open(legacy_catalog_file, 'r', newline='') as f:
+            reader = csv.reader(f, delimiter='\t')
+            # skip the header
+            next(reader, None)
+            index.executemany("INSERT OR REPLACE INTO idx VALUES (?, ?)",
+                              ((path, float(mtime)) for path, mtime in (row for row in reader if len(row) == 2)))
+        index.commit()
 
-        for path, timestamp in index.items():
-            f.write("%s\t%s\n" % (path, timestamp))
+    return index
 
 
 def catalog2():
-    def path_mtime():
-        return os.path.abspath(source_picture), os.path.getmtime(source_picture)
-
-    def log(s, flush=False):
+    def log(s):
         if not args.quiet:
-            if flush:
-                print(s, end='', flush=True)
-            else:
-                print(s)
+            print(s)
 
     source = os.path.expanduser(args.source)
     target = os.path.expanduser(args.target)
     assert os.path.exists(source), "Source folder doesn't exist"
 
-    index = _load_catalog_index()
+    index = _open_catalog_index()
 
     if not os.path.exists(target):
         os.makedirs(target, exist_ok=True)
 
-    exts = ['.' + e for e in args.ext.split(",")]
+    suffixes = _suffixes(args.ext)
+    size = _parse_size(args.resize)
     forced_resize = args.force
 
     sources = 0
     skipped = 0
     replaced = 0
 
+    pictures = []
+
     source = source[:-1] if source[-1] == '/' else source
     root_count = source.count('/')
 
-    for root, folders, files in os.walk(source, topdown=True):
-        folders.sort()
+    for root, entries in _walk(source, suffixes, skip_hidden=True):
         level = root.count('/') - root_count
         _spacer = '  ' * level
 
-        if os.path.basename(os.path.normpath(root))[0] == '.':
-            continue
-
         if level > 0:
             log(_spacer + " - " + os.path.basename(root))
 
         target_root = os.path.join(target, root[len(source) + 1:])
-        for file in sorted([f for f in files if os.path.splitext(f)[1].lower() in exts]):
-            source_picture = os.path.join(root, file)
+        for entry in entries:
+            file = entry.name
+            source_picture = entry.path
             target_picture = os.path.join(target_root, file)
-            log('%s  -  %s -> ' % (_spacer, file), True)
             sources += 1
 
-            path, mtime = path_mtime()
-            source_changed = path in index and index[path] != mtime
-            target_exists = os.path.exists(target_picture)
+            # a single stat per file: the entry caches the source one, the target one gives also its existence
+            path, mtime = os.path.abspath(source_picture), entry.stat().st_mtime
+            try:
+                target_exists = True
+                target_outdated = os.stat(target_picture).st_mtime < mtime
+            except FileNotFoundError:
+                target_exists = False
+                target_outdated = True
+            indexed = index.execute("SELECT mtime FROM idx WHERE path = ?", (path,)).fetchone()
+            source_changed = (indexed is not None and indexed[0] != mtime) or target_outdated
 
             if source_changed or forced_resize or not target_exists:
                 repl = False
                 if target_exists:
-                    os.remove(target_picture)
                     replaced += 1
                     repl = True
-                os.makedirs(os.path.dirname(target_picture), exist_ok=True)
-                shutil.copyfile(source_picture, target_picture)
-                subprocess.call(["mogrify", "-resize", args.resize, target_picture])
-                if repl:
-                    log("replaced.")
-                else:
-                    log('generated.')
+                pictures.append((source_picture, target_picture))
+                outcome = "replaced." if repl else "generated."
             else:
-                log("skipped.")
+                outcome = "skipped."
                 skipped += 1
 
-            index[os.path.abspath(source_picture)] = os.path.getmtime(source_picture)
+            # one line, written at once, per file
+            log('%s  -  %s -> %s' % (_spacer, file, outcome))
 
-    _write_catalog_index(index)
+            if indexed is None or indexed[0] != mtime:
+                index.execute("INSERT OR REPLACE INTO idx VALUES (?, ?)", (path, mtime))
+
+        index.commit()
+
+    failed = 0
+    if pictures:
+        log("Resizing %d pictures..." % len(pictures))
+        failed = _resize_pictures(pictures, size)
+
+    index.close()
     print("""
 Catalog generation done
     Source folder: %s
@@ -216,11 +340,13 @@ Catalog generation done
     Found %d pictures
     Skipped %d pictures
     Generated %d pictures (%d replaced)
-""" % (source, target, sources, skipped, (sources - skipped), replaced))
+    Failed %d pictures
+""" % (source, target, sources, skipped, (sources - skipped - failed), replaced, failed))
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
+    parser.add_argument('--verbose', action='store_true')
 
     subparsers = parser.add_subparsers()
 
@@ -236,7 +362,7 @@ if __name__ == '__main__':
     catalog_parser.add_argument("source", help="Original directory from where creating the catalog")
     catalog_parser.add_argument("target", help="Final destination of the catalog")
     catalog_parser.add_argument("--resize", default="1920x1080",
-                                help="Resize value of the pictures (default 1920x1080")
+                                help="Maximum size of the pictures as WIDTHxHEIGHT (default 1920x1080)")
     catalog_parser.add_argument("--ext", default="jpg,jpeg",
                                 help="Extensions valid to be copied, separated by comma")
     catalog_parser.add_argument("--force", action='store_true',
@@ -247,7 +373,7 @@ if __name__ == '__main__':
     catalog_parser2.add_argument("source", help="Original directory from where creating the catalog")
     catalog_parser2.add_argument("target", help="Final destination of the catalog")
     catalog_parser2.add_argument("--resize", default="1920x1080",
-                                 help="Resize value of the pictures (default 1920x1080")
+                                 help="Maximum size of the pictures as WIDTHxHEIGHT (default 1920x1080)")
     catalog_parser2.add_argument("--ext", default="jpg,jpeg",
                                  help="Extensions valid to be copied, separated by comma")
     catalog_parser2.add_argument("--force", action='store_true',
@@ -263,16 +389,19 @@ if __name__ == '__main__':
     pshowcase_parser.add_argument("--remove", action="store_true", help="Delete all showcase folders")
 
     args = parser.parse_args()
-    if args.command:
-        if args.command == 'showcase':
-            showcase()
-        elif args.command == 'catalog':
-            catalog()
-        elif args.command == 'catalog2':
-            catalog2()
-        elif args.command == 'permanent_showcase':
-            permanent_showcase()
-        else:
-            parser.print_usage()
+
+    logging.basicConfig(
+        format='%(message)s',
+        level=logging.DEBUG if args.verbose else logging.INFO)
+
+    commands = {
+        'showcase': showcase,
+        'catalog': catalog,
+        'catalog2': catalog2,
+        'permanent_showcase': permanent_showcase,
+    }
+
+    if hasattr(args, 'command'):
+        commands[args.command]()
     else:
         parser.print_usage()
@@ -1,6 +1,7 @@
 import argparse
 import collections
 import configparser
+import fcntl
 import getpass
 import logging
 import os
@@ -8,6 +9,8 @@ import re
 import shutil
 import sys
 import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import sh
 
@@ -16,38 +19,110 @@ import _common
 config = configparser.ConfigParser(dict_type=collections.OrderedDict)
 all_tasks = []
 all_names = set()
+all_tags = {}
+content_filter = None
+mount_type = None
 
 __sudo_passwd = None
 
+DEFAULT_JOBS = 4
+MOUNT_POINT = os.path.expanduser("~/.cache/mybkp/mp")
+MOUNTS_FILE = "/proc/self/mounts"
+
 
 class Mount:
+    """
+    Mount the repository on a stable mount point, reusing it when the configured source is still mounted there
+    (i.e. by the mount command)
+    """
+
     def __init__(self, keep_mounted=False):
-        self.mount_point = tempfile.mkdtemp('.tmp', 'mybkp_')
+        self.mount_point = MOUNT_POINT
+        self.parent = os.path.dirname(self.mount_point)
+        # present while the repository is left mounted on purpose by the mount command
+        self.keep_file = self.mount_point + ".keep"
         self.keep_mounted = keep_mounted
+        self.mounted = False
+        self.lock = None
 
     def __enter__(self):
-        logging.debug("Mounting repository...")
-        with _sudo():
-            sh.mount(*self.__mount_parameters())
-        logging.debug("...mounted")
-        return self.mount_point.__str__()
+        os.makedirs(self.mount_point, exist_ok=True)
+
+        # only one mybkp at a time can use the mount point
+        self.lock = open(self.mount_point + ".lock", 'w')
+        try:
+            fcntl.flock(self.lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            print("Waiting for another mybkp using %s..." % self.mount_point)
+            fcntl.flock(self.lock, fcntl.LOCK_EX)
+
+        mounted_source = self.__mounted_source()
+        if mounted_source is None:
+            logging.debug("Mounting repository...")
+            with _sudo():
+                sh.mount(*self.__mount_parameters())
+            self.mounted = True
+            logging.debug("...mounted")
+        elif mounted_source != _mount_source().rstrip('/'):
+            self.lock.close()
+            raise RuntimeError("%s is already mounted from %s instead of %s, dismount it first"
+                               % (self.mount_point, mounted_source, _mount_source()))
+        elif os.path.exists(self.keep_file):
+            logging.debug("Repository already mounted")
+        else:
+            # left behind by a run which didn't get to dismount it
+            logging.debug("Repository left mounted, reused")
+            self.mounted = True
+
+        if self.keep_mounted:
+            open(self.keep_file, 'w').close()
+        elif self.mounted and os.path.exists(self.keep_file):
+            os.remove(self.keep_file)
+        return self.mount_point
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        if not self.keep_mounted:
-            if os.path.ismount(self.mount_point.__str__()):
+        try:
+            # a mount kept by the mount command is left mounted
+            if self.mounted and not self.keep_mounted and self.__is_mounted():
                 logging.info("Dismounting repository...")
                 with _sudo():
-                    sh.umount(self.mount_point.__str__())
+                    sh.umount(self.mount_point)
                 logging.info("...dismounted")
-
-            shutil.rmtree(self.mount_point)
+        finally:
+            self.lock.close()
+
+    def __is_mounted(self):
+        # the mount point is a plain directory we own: comparing it with its (known) parent is enough
+        s1 = os.lstat(self.mount_point)
+        s2 = os.lstat(self.parent)
+        return s1.st_dev != s2.st_dev or s1.st_ino == s2.st_ino
+
+    def __mounted_source(self):
+        """
+        Return the source mounted on the mount point (the last one, if stacked) or None if nothing is mounted
+        """
+        if not self.__is_mounted():
+            return None
+
+        def unescape(field):
+            # blanks and backslashes are written as octal escapes
+            return re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), field)
+
+        mount_point = os.path.realpath(self.mount_point)
+        source = None
+        with open(MOUNTS_FILE) as mounts:
+            for line in mounts:
+                fields = line.split()
+                if len(fields) > 1 and unescape(fields[1]) == mount_point:
+                    source = unescape(fields[0]).rstrip('/')
+        return source
 
     def __mount_parameters(self):
         source_settings = config['source']
         if _is_cifs_mount():
             __params = ["-t", "cifs",
-                        "//%s%s" % (source_settings.get('server'), source_settings.get('base_folder')),
-                        self.mount_point.__str__(),
+                        _mount_source(),
+                        self.mount_point,
                         '-o', 'uid=%d' % os.getuid(),
                         '-o', 'gid=%d' % os.getgid(),
                         '-o', 'username=%s,noexec' % source_settings.get('user'),
@@ -55,8 +130,8 @@ class Mount:
 
         elif _is_nfs_mount():
             __params = ["-t", "nfs",
-                        "%s:%s" % (source_settings.get('server'), source_settings.get('base_folder')),
-                        self.mount_point.__str__()
+                        _mount_source(),
+                        self.mount_point
                         ]
         else:
             raise ValueError("Mount type '%s' not valid" % source_settings['mount_type'])
@@ -95,30 +170,34 @@ class Task:
         else:
             self.tags = None
 
+    def get_sub_folders(self):
+        if content_filter is None:
+            return self.sub_folders
+        return [f for f in self.sub_folders if content_filter.search(f)]
+
+    def get_remote_root(self, mount_point):
+        # the remote root is always relative to the mount point, even if written with a leading slash
+        # (os.path.join would discard the mount point); it always ends with a slash
+        return mount_point + '/' + self.remote_root.lstrip('/')
+
     def get_contents(self, mount_point):
-        content_filter = re.compile(args.content if args.content else '.*')
-        for sub_folder in (f for f in self.sub_folders if content_filter.search(f)):
+        remote_root = self.get_remote_root(mount_point)
+        for sub_folder in self.get_sub_folders():
             destination = sub_folder[1:] if len(sub_folder) > 0 and sub_folder[0] == '.' else sub_folder
-            yield (os.path.join(self.local_root, sub_folder), os.path.join(mount_point, self.remote_root, destination))
+            yield self.local_root + sub_folder, remote_root + destination
 
 
 def show():
     if args.subject == 'tasks':
         print("Enabled tasks:")
-        [print("  " + s.name) for s in _get_tasks(lambda t: t.enabled)]
+        for s in _get_tasks(lambda t: t.enabled):
+            print("  " + s.name)
         print("\nDisabled tasks:")
-        [print("  " + s.name) for s in _get_tasks(lambda t: not t.enabled)]
+        for s in _get_tasks(lambda t: not t.enabled):
+            print("  " + s.name)
     elif args.subject == 'tags':
-        tags = {}
-        for task in (t for t in _get_tasks() if t.tags):
-            for tag in task.tags:
-                if tag in tags:
-                    tags[tag].append(task)
-                else:
-                    tags[tag] = [task]
-
-        if tags:
-            for tag, tasks in tags.items():
+        if all_tags:
+            for tag, tasks in all_tags.items():
                 print("Tag '%s'" % tag)
                 for task in tasks:
                     print("  %s" % task.name)
@@ -140,15 +219,17 @@ def backup_restore(is_backward_direction=False):
             print("'%s' is not either a valid task or valid tag" % task_name)
             sys.exit(1)
 
+    selected = set(args.tasks)
+
     def eligible(t: Task):
         enabled = t.enabled or args.force
-        no_task_specified = len(args.tasks) == 0
-        is_specified_task = t.name in args.tasks
-        is_tagged_task = t.tags and [t for t in t.tags if t in args.tasks]
+        no_task_specified = not selected
+        is_specified_task = t.name in selected
+        is_tagged_task = t.tags and not selected.isdisjoint(t.tags)
         return enabled and (no_task_specified or is_specified_task or is_tagged_task)
 
-    def build_parameters():
-        __params = ["-vzhirltoD"] if _is_cifs_mount() else ["-avzhi"]
+    def build_parameters(task):
+        __params = list(rsync_flags)
 
         if args.verbose:
             __params.append('--verbose')
@@ -162,28 +243,98 @@ def backup_restore(is_backward_direction=False):
         if task.exclude:
             __params += ["--exclude=%s" % excl for excl in task.exclude]
 
-        __filters = list()
-        if args.folder:
-            __filters.append(("--exclude", "*"))
-
-            for a_folder in args.folder:
-                head = a_folder if a_folder[-1] == '/' else a_folder + '/'
-                if head[0] == '/':
-                    head = head[1:]
+        __params += folder_filter_params
 
-                __filters.append(("--include", "%s**" % head))
+        return __params
 
-                while True:
-                    head, tail = os.path.split(head)
-                    if head == '':
-                        break
-                    __filters.append(("--include", "%s/" % head))
+    def sync(params, source, destination, log, files_from=None):
+        if is_backward_direction:
+            __s = source
+            source = destination
+            destination = __s
 
-            for option, value in reversed(__filters):
-                __params.append(option)
-                __params.append(value)
+        sync_text = "syncing {} -> {} ...".format(source, destination[len(mount_point):])
+        print(sync_text)
 
-        return __params
+        if args.verbose:
+            print('rsync', *params, source, destination)
+
+        log.write(("\n>> %s\n" % sync_text).encode())
+        sh.rsync(*params, source, destination, _out=log, _in=files_from)
+
+    def batchable(task, sub_folders):
+        """
+        Tell if the sub-folders can be synchronized by a single rsync rooted at the local root instead of their own
+        """
+        # the sub-folders must keep their name on the remote side (no leading dot, which is removed) and be copied
+        # by content (trailing slash); anchored excludes or excludes with a path depend on the transfer root
+        return all(f and f[0] != '.' and f[-1] == '/' for f in sub_folders) \
+            and not any(excl[0] == '/' or '/' in excl.rstrip('/') for excl in task.exclude)
+
+    def run_task(task, log):
+        log.write("-------------------------- {task}: {local} -> {remote} {delete} --------------------------"
+                  .format(task=task.name,
+                          local=task.local_root,
+                          remote=task.remote_root,
+                          delete="(with delete)" if task.delete_missing else "",
+                          )
+                  .encode())
+
+        params = build_parameters(task)
+
+        sub_folders = task.get_sub_folders()
+        if len(sub_folders) > 1 and not args.folder and batchable(task, sub_folders):
+            # the list is read from the standard input; with --files-from the recursion is not implied by -a
+            sync(params + ['-r', '--files-from=-'],
+                 task.local_root, task.get_remote_root(mount_point), log,
+                 files_from="\n".join(sub_folders) + "\n")
+        else:
+            for source, destination in task.get_contents(mount_point):
+                sync(params, source, destination, log)
+
+    def run_tasks(device_tasks):
+        """
+        Run one after the other the tasks sharing the same local device, each one logging on its own
+        """
+        for task in device_tasks:
+            # unbuffered, so that rsync (writing straight into its descriptor) and the headers keep their order
+            with tempfile.TemporaryFile(prefix="mybkp_", buffering=0) as task_log:
+                try:
+                    run_task(task, task_log)
+                finally:
+                    task_log.seek(0)
+                    with log_lock:
+                        shutil.copyfileobj(task_log, log_file)
+
+    def local_device(task):
+        try:
+            return os.stat(task.local_root).st_dev
+        except OSError:
+            return task.local_root
+
+    rsync_flags = ["-vzhirltoD"] if _is_cifs_mount() else ["-avzhi"]
+
+    # the folder filters only depend on the command line, they are the same for every task
+    folder_filter_params = []
+    if args.folder:
+        __filters = [("--exclude", "*")]
+
+        for a_folder in args.folder:
+            head = a_folder if a_folder[-1] == '/' else a_folder + '/'
+            if head[0] == '/':
+                head = head[1:]
+
+            __filters.append(("--include", "%s**" % head))
+
+            while True:
+                head, tail = os.path.split(head)
+                if head == '':
+                    break
+                __filters.append(("--include", "%s/" % head))
+
+        for option, value in reversed(__filters):
+            folder_filter_params.append(option)
+            folder_filter_params.append(value)
 
     tasks = list(_get_tasks(eligible))
 
@@ -205,33 +356,14 @@ Selected tasks          : {tasks}
                                tasks=", ".join([t.name for t in tasks]))
                        .encode())
 
+        # tasks on different local devices don't compete for the same disk, they are synchronized together
+        devices = {}
         for task in tasks:
-            log_file.write("-------------------------- {task}: {local} -> {remote} {delete} --------------------------"
-                           .format(task=task.name,
-                                   local=task.local_root,
-                                   remote=task.remote_root,
-                                   delete="(with delete)" if task.delete_missing else "",
-                                   )
-                           .encode())
-
-            params = build_parameters()
-
-            for source, destination in task.get_contents(mount_point):
-                if is_backward_direction:
-                    __s = source
-                    source = destination
-                    destination = __s
-
-                sync_text = "syncing {} -> {} ...".format(source, destination[len(mount_point):])
-                print(sync_text)
-
-                if args.verbose:
-                    print(" ".join(['rsync'] + params + [source, destination]))
+            devices.setdefault(local_device(task), []).append(task)
 
-                log_file.write("\n>> ".encode())
-                log_file.write(sync_text.encode())
-                log_file.write("\n".encode())
-                sh.rsync(*params, source, destination, _out=log_file)
+        log_lock = threading.Lock()
+        with ThreadPoolExecutor(max_workers=max(1, min(args.jobs, len(devices)))) as executor:
+            list(executor.map(run_tasks, devices.values()))
 
     sh.less(log_file.name, _fg=True)
 
@@ -255,12 +387,19 @@ def _get_tasks(task_filter=None):
             yield task
 
 
+def _mount_source():
+    source_settings = config['source']
+    if _is_cifs_mount():
+        return "//%s%s" % (source_settings.get('server'), source_settings.get('base_folder'))
+    return "%s:%s" % (source_settings.get('server'), source_settings.get('base_folder'))
+
+
 def _is_nfs_mount():
-    return config['source']['mount_type'].lower() == 'nfs'
+    return mount_type == 'nfs'
 
 
 def _is_cifs_mount():
-    return config['source']['mount_type'].lower() == 'cifs'
+    return mount_type == 'cifs'
 
 
 def __check_and_create_tasks():
@@ -268,10 +407,12 @@ def __check_and_create_tasks():
     names = {t.name for t in _tasks}
     all_names.update(names)
 
-    for _task in [t for t in _tasks if t.tags]:
-        for tag in _task.tags:
+    # the tasks of each tag are collected while checking the names
+    for _task in _tasks:
+        for tag in _task.tags or []:
             assert tag not in names, "Tag name '%s' conflicts with task name" % tag
-        all_names.update(_task.tags)
+            all_tags.setdefault(tag, []).append(_task)
+    all_names.update(all_tags)
 
     return _tasks
 
@@ -297,6 +438,10 @@ if __name__ == '__main__':
                                 help='Folder filter (starting from the root with no leading slash) for rsync')
         bkp_parser.add_argument('--content',
                                 help='Content filter (regexp) for selecting sub-folders')
+        bkp_parser.add_argument('--jobs', type=int, default=DEFAULT_JOBS,
+                                help='Maximum number of tasks synchronized at the same time (default %d), '
+                                     'tasks on the same local device are always run one after the other'
+                                     % DEFAULT_JOBS)
         bkp_parser.add_argument('tasks', nargs='*', help='Tasks to be backupped (or empty for all active tasks)')
 
     show_parser = sub_parsers.add_parser("show", help="Show useful information")
@@ -315,12 +460,21 @@ if __name__ == '__main__':
     if args.verbose:
         logging.getLogger("sh").setLevel(logging.INFO)
 
+    if getattr(args, 'content', None):
+        content_filter = re.compile(args.content)
+
     if hasattr(args, 'command'):
         _common.load_configuration(args.config if args.config else 'mybkp.ini', parser=config)
+        mount_type = config['source']['mount_type'].lower()
 
         # initialize tasks
         all_tasks = __check_and_create_tasks()
 
-        eval("%s()" % args.command)
+        {
+            'backup': backup,
+            'restore': restore,
+            'show': show,
+            'mount': mount,
+        }[args.command]()
     else:
         parser.print_help()
@@ -3,10 +3,11 @@ import collections
 import os
 import re
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
-IMAGE_EXTS = ["cr2", "cr3", "jpg", "3fr", "raf"]
-EXIF_TAGS_RE = re.compile("^(?P<tag>Exif\.[\w\.]+)\s+(?P<type>\w+)\s+(?P<size>\d+)\s+(?P<value>.+)$")
+IMAGE_EXTS = frozenset(["cr2", "cr3", "jpg", "3fr", "raf"])
+EXIV2_WORKERS = os.cpu_count() or 1
 
 ExifTag = collections.namedtuple('ExifTag', 'tag, type, size, value')
 
@@ -16,8 +17,11 @@ def load_exiv2_data(image_file):
 
     tags = {}
 
-    for tag in (ExifTag(*EXIF_TAGS_RE.search(line).groups()) for line in out.decode('utf-8').splitlines()):
-        tags[tag.tag] = tag.value
+    # every line is: tag, type, size and value separated by blanks; the value may contain blanks itself or be empty
+    for fields in (line.split(None, 3) for line in out.decode('utf-8').splitlines()):
+        if len(fields) >= 3:
+            tag = ExifTag(*fields) if len(fields) == 4 else ExifTag(*fields, value='')
+            tags[tag.tag] = tag.value
 
     return tags
 
@@ -46,7 +50,8 @@ FIELD_TAGS = {
 
 
 def is_image(file):
-    return os.path.splitext(file)[-1][1:].lower() in IMAGE_EXTS
+    _, dot, ext = file.rpartition('.')
+    return dot == '.' and ext.lower() in IMAGE_EXTS
 
 
 def find_images(target):
@@ -54,7 +59,9 @@ def find_images(target):
         for _image_file in [t for t in [target] if is_image(t)]:
             yield _image_file
     else:
-        for _image_file in [f for f in sorted(os.listdir(target)) if is_image(f)]:
+        with os.scandir(target) as it:
+            _image_files = sorted(e.name for e in it if is_image(e.name) and e.is_file())
+        for _image_file in _image_files:
             yield os.path.join(target, _image_file)
 
 
@@ -65,7 +72,7 @@ def split_filename(file):
 
 
 class ImageInfo:
-    def __init__(self, image_file, new_name_segments):
+    def __init__(self, image_file, new_name_segments, folder_side_files):
         self.file = image_file
         self.folder = os.path.dirname(image_file)
 
@@ -81,7 +88,7 @@ class ImageInfo:
 
         # retrieve side files
         _name, _ = split_filename(image_file)
-        self.side_files = [f for f in os.listdir(self.folder) if not is_image(f) and f.startswith(_name)]
+        self.side_files = [f for f in folder_side_files if f.startswith(_name)]
 
     def get_renames(self, element_count=None):
         """
@@ -149,6 +156,9 @@ class Counters:
 def unprocessed():
 
     class Proc:
+        # one per file of the scanned tree
+        __slots__ = ('key', 'images', 'sidecars', 'accessories')
+
         def __init__(self, filename):
             def is_sidecar():
                 for sext in args.sidecar_file:
@@ -251,24 +261,38 @@ def rename():
 
         folder_count = Counters()
 
-        images_info = dict()
-        for image_file in find_images(target):
-            folder_count.original_images += 1
-            try:
-                ii = ImageInfo(image_file, name_segments)
-                if ii.new_name not in images_info:
-                    images_info[ii.new_name] = list()
+        # the folder is listed once, each image picks its side files from here
+        folder = target if os.path.isdir(target) else os.path.dirname(target)
+        side_files = [f for f in os.listdir(folder) if not is_image(f)]
 
-                images_info[ii.new_name].append(ii)
+        def load_image_info(image_file):
+            try:
+                return ImageInfo(image_file, name_segments, side_files)
             except ValueError as e:
+                return e
+
+        # exiv2 is run for each image: the images are read in parallel, the results are handled in order
+        images_info = dict()
+        image_files = list(find_images(target))
+        with ThreadPoolExecutor(max_workers=EXIV2_WORKERS) as executor:
+            loaded_images = list(executor.map(load_image_info, image_files))
+
+        for image_file, ii in zip(image_files, loaded_images):
+            folder_count.original_images += 1
+            if isinstance(ii, ValueError):
                 __filename = os.path.basename(image_file)
                 if args.stop_on_fail:
-                    raise RuntimeError("Cannot rename file %s " % __filename, e)
+                    raise RuntimeError("Cannot rename file %s " % __filename, ii)
                 else:
-                    print("{orig:30s} -> ERROR ({err}) ".format(orig=__filename, err=str(e)))
+                    print("{orig:30s} -> ERROR ({err}) ".format(orig=__filename, err=str(ii)))
                     folder_count.error += 1
                     continue
 
+            if ii.new_name not in images_info:
+                images_info[ii.new_name] = list()
+
+            images_info[ii.new_name].append(ii)
+
         for new_name in images_info.keys():
             _alone = len(images_info[new_name]) == 1
             _c = None if _alone else -1
@@ -363,4 +387,10 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
-    eval("%s()" % args.command)
+    if hasattr(args, 'command'):
+        {
+            'rename': rename,
+            'unprocessed': unprocessed,
+        }[args.command]()
+    else:
+        parser.print_usage()